@@ -4,15 +4,18 @@ import os
 import json
 import subprocess
 import sys
-import random
 import shutil
+import signal
+import socket
+import tempfile
 import time
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from enum import Enum, auto
 from glob import glob
 from typing import NamedTuple, Optional, Union
 import re
+from bisect import bisect_right
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
@@ -33,6 +36,11 @@ rival_time = None
 rival_time_lock = Lock()
 cur_testcases = None
 
+# --profile 使用的 qemu 插件，一般位于 qemu 源码的 build/contrib/plugins/libhotblocks.so
+qemu_plugin_path = "libhotblocks.so"
+# 性能分析报告中列出的热点基本块数量
+PROFILE_TOP = 20
+
 
 class Config(NamedTuple):
     compiler: str
@@ -44,6 +52,12 @@ class Config(NamedTuple):
     on_riscv: bool
     store_time: bool
     rival_compiler: str
+    profile: bool
+    shard: Optional[tuple[int, int]]
+    durations: Optional[str]
+    result: Optional[str]
+    keep_failed: bool
+    keep_all: bool
 
 
 class Result(Enum):
@@ -71,6 +85,16 @@ def arithmetic_mean(numbers):
 
     return sum(numbers) / len(numbers)
 
+def parse_shard(value: str) -> tuple[int, int]:
+    matches = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not matches:
+        raise ArgumentTypeError(f'invalid shard "{value}", expected i/N')
+    index, count = int(matches.group(1)), int(matches.group(2))
+    if not 1 <= index <= count:
+        raise ArgumentTypeError(f'invalid shard "{value}", expected 1 <= i <= N')
+    return index, count
+
+
 def get_config(argv: list[str]) -> Config:
     global cc
     global rival_compiler
@@ -91,12 +115,34 @@ def get_config(argv: list[str]) -> Config:
     parser.add_argument('-b', '--benchmark', action='store_true', default=False, help='benchmark time')
     parser.add_argument("--on_riscv", action='store_true', default=False, help='is on a riscv machine')
     parser.add_argument("--store_time", action='store_true', default=False, help='whether to store time result')
+    parser.add_argument("--profile", action='store_true', default=False,
+                        help='profile hot blocks of testcases slower than the rival (requires -b and qemu)')
+    parser.add_argument("--shard", metavar='<i/N>', type=parse_shard, default=None,
+                        help='only run the i-th (1-based) of N shards of the testcases')
+    parser.add_argument("--durations", metavar='<durations>', default=None,
+                        help='json file of historical testcase durations used to balance shards')
+    parser.add_argument("--result", metavar='<result>', default=None,
+                        help='write machine-readable results of this run to a json file')
+    parser.add_argument("--workdir", metavar='<workdir>', default='build',
+                        help='directory in which each run creates its own working directory')
+    parser.add_argument("--tmpfs", action='store_true', default=False,
+                        help='put the working directory on tmpfs (/dev/shm) instead of --workdir')
+    parser.add_argument("--keep_failed", action='store_true', default=False,
+                        help='keep the build artifacts of testcases that did not pass')
+    parser.add_argument("--keep_all", action='store_true', default=False,
+                        help='keep the build artifacts of all testcases')
     index: int
     try:
         index = argv.index('--')
     except ValueError:
         index = len(argv)
     args = parser.parse_args(argv[:index])
+    if args.profile and not args.benchmark:
+        parser.error('--profile requires -b/--benchmark')
+    if args.profile and args.on_riscv:
+        parser.error('--profile runs executables under qemu and cannot be used with --on_riscv')
+    if args.durations is not None and args.shard is None:
+        parser.error('--durations is only used to balance shards and requires --shard')
     cc = args.compiler
     # 如果存在文件 ./args.compiler/args.compiler, 就将这个路径赋值给 cc
     path_to_rival = "./rivals/{}/{}".format(args.rival_compiler, args.rival_compiler)
@@ -115,25 +161,79 @@ def get_config(argv: list[str]) -> Config:
         rival_time = rival_time.get(args.testcases)
     if rival_time is None:
         rival_time = {}
+    tempdir = args.workdir
+    if args.tmpfs:
+        # /dev/shm 常以 noexec 挂载（如 Docker），此时无法在 riscv 机器上直接运行可执行文件
+        if not os.path.isdir('/dev/shm') or not os.access('/dev/shm', os.W_OK):
+            print('\033[0;33m/dev/shm is not writable, using {}\033[0m'.format(tempdir), flush=True)
+        elif args.on_riscv and os.statvfs('/dev/shm').f_flag & os.ST_NOEXEC:
+            print('\033[0;33m/dev/shm is mounted noexec, using {}\033[0m'.format(tempdir), flush=True)
+        else:
+            tempdir = '/dev/shm'
     return Config(compiler=compiler_path,
                   testcases=args.testcases,
                   optimize_level=args.optimize_level,
-                  tempdir='build',
+                  tempdir=tempdir,
                   parallel=args.parallel,
                   timing=args.benchmark,
                   on_riscv=args.on_riscv,
                   store_time=args.store_time,
-                  rival_compiler=args.rival_compiler
+                  rival_compiler=args.rival_compiler,
+                  profile=args.profile,
+                  shard=args.shard,
+                  durations=args.durations,
+                  result=args.result,
+                  keep_failed=args.keep_failed,
+                  keep_all=args.keep_all
                   )
 
 
-def get_testcases(config: Config) -> list[str]:
+def get_suite(testcases: str) -> str:
+    # 测试文件夹的路径在不同机器上可能不同，耗时记录和分片结果以文件夹名为键
+    return os.path.basename(os.path.normpath(testcases))
+
+
+def get_all_testcases(config: Config) -> list[str]:
     testcases = [os.path.splitext(os.path.basename(file))[0]
                  for file in glob(os.path.join(config.testcases, '*.sy'))]
     testcases.sort()
     return testcases
 
 
+def get_testcases(config: Config) -> list[str]:
+    testcases = get_all_testcases(config)
+    if config.shard is not None:
+        weights = None
+        if config.durations is not None:
+            if os.path.exists(config.durations):
+                weights = json.load(open(config.durations, "r")).get(get_suite(config.testcases))
+            if not weights:
+                print('\033[0;33mno durations of "{}" in {}, sharding without weights\033[0m'
+                      .format(get_suite(config.testcases), config.durations), flush=True)
+        testcases = select_shard(testcases, *config.shard, weights)
+    return testcases
+
+
+def select_shard(
+    testcases: list[str],
+    index: int,
+    count: int,
+    weights: Optional[dict[str, float]] = None
+) -> list[str]:
+    # 只依赖排序后的测例名与历史耗时，保证不同机器上的划分一致
+    if not weights:
+        return testcases[index - 1::count]
+    default = arithmetic_mean(list(weights.values()))
+    # 贪心：按耗时从大到小，每次分给当前总耗时最小的分片
+    loads = [0.0] * count
+    shards: list[list[str]] = [[] for _ in range(count)]
+    for testcase in sorted(testcases, key=lambda t: (-weights.get(t, default), t)):
+        target = min(range(count), key=lambda i: (loads[i], i))
+        loads[target] += weights.get(testcase, default)
+        shards[target].append(testcase)
+    return sorted(shards[index - 1])
+
+
 def get_answer(file: str) -> tuple[list[str], int]:
     content = [line.strip() for line in open(file).read().splitlines()]
     return content[:-1], int(content[-1])
@@ -197,16 +297,225 @@ def run(
         return Result.PASSED
 
 
+def binutil(name: str) -> str:
+    # riscv64-unknown-elf-gcc -> riscv64-unknown-elf-nm, gcc -> nm
+    return cc[:-len('gcc')] + name if cc.endswith('gcc') else name
+
+
+def get_symbols(executable: str) -> list[tuple[int, str, str]]:
+    proc = subprocess.run([binutil('nm'), '-n', executable], capture_output=True, text=True)
+    symbols = []
+    for line in proc.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[1] in ('t', 'T'):
+            symbols.append((int(parts[0], 16), parts[2], parts[1]))
+    return symbols
+
+
+def disassemble(executable: str, pc: int, icount: int) -> list[str]:
+    # 压缩指令为 2 字节，按 4 字节估计上界后只取前 icount 条
+    proc = subprocess.run([binutil('objdump'), '-d', '--no-show-raw-insn',
+                           f'--start-address={pc:#x}', f'--stop-address={pc + 4 * icount:#x}',
+                           executable], capture_output=True, text=True)
+    insns = []
+    for line in proc.stdout.splitlines():
+        matches = re.match(r'\s*[0-9a-fA-F]+:\s+(.*)', line)
+        if matches:
+            insns.append(matches.group(1).replace('\t', ' ').strip())
+    return insns[:icount]
+
+
+def get_labels(assembly: str) -> tuple[set[str], set[str]]:
+    # 找出汇编中的所有标签，以及其中声明为函数或全局的符号
+    labels = set()
+    functions = set()
+    for line in open(assembly).read().splitlines():
+        matches = re.match(r'\s*([\w.$]+):', line)
+        if matches:
+            labels.add(matches.group(1))
+            continue
+        matches = re.match(r'\s*(?:\.type\s+([\w.$]+)\s*,\s*[@%]function|\.globa?l\s+([\w.$]+))', line)
+        if matches:
+            functions.add(matches.group(1) or matches.group(2))
+    return labels, functions
+
+
+def hot_blocks(
+    workdir: str,
+    assembly: str,
+    input: str
+) -> Optional[tuple[str, list[tuple[int, int, int]], list[tuple[int, str, str]]]]:
+    name_body = os.path.basename(assembly).split('.')[0]
+    executable = os.path.join(workdir, name_body + '.prof.exec')
+    log = os.path.join(workdir, name_body + '.prof.log')
+    # -Wa,-L 保留 .L 开头的局部标签，使基本块能对应回汇编中的标签
+    if os.system(f'{cc} {gcc_args} -Wa,-L {assembly} runtime/libsysy.a'
+                 f' -o {executable}') != 0:
+        return None
+    proc = subprocess.Popen(
+        ["qemu-riscv64", "-plugin", qemu_plugin_path, "-d", "plugin", "-D", log, executable],
+        stdin=open(input) if os.path.exists(input) else None,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        proc.wait(TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        return None
+    if not os.path.exists(log):
+        return None
+    # hotblocks 插件输出格式: pc, tcount, icount, ecount
+    # 注意：qemu 自带的 libhotblocks.so 只输出执行次数最多的 20 个基本块
+    blocks = []
+    for line in open(log).read().splitlines():
+        matches = re.match(r'\s*0x([0-9a-fA-F]+),\s*(\d+),\s*(\d+),\s*(\d+)', line)
+        if matches:
+            pc, icount, ecount = int(matches.group(1), 16), int(matches.group(3)), int(matches.group(4))
+            blocks.append((pc, icount, ecount))
+    blocks.sort(key=lambda b: b[1] * b[2], reverse=True)
+    return executable, blocks, get_symbols(executable)
+
+
+def annotate(
+    title: str,
+    assembly: str,
+    executable: str,
+    blocks: list[tuple[int, int, int]],
+    symbols: list[tuple[int, str, str]]
+) -> tuple[list[str], dict[str, int]]:
+    labels, declared = get_labels(assembly)
+    # 全局符号和汇编中声明为函数或全局的符号视为函数，汇编中的其余标签视为基本块，
+    # 不在汇编中的符号（运行时库等）也视为函数
+    functions = [(addr, name) for addr, name, kind in symbols
+                 if kind == 'T' or name in declared
+                 or (name not in labels and not name.startswith('.L'))]
+    label_addrs = [addr for addr, _, _ in symbols]
+    function_addrs = [addr for addr, _ in functions]
+
+    def lookup(table, addrs, pc):
+        index = bisect_right(addrs, pc) - 1
+        if index < 0:
+            return '??', 0
+        return table[index][1], pc - table[index][0]
+
+    # 函数权重基于插件输出的全部基本块，而不仅是下面列出的前 PROFILE_TOP 个
+    per_function: dict[str, int] = {}
+    for pc, icount, ecount in blocks:
+        function, _ = lookup(functions, function_addrs, pc)
+        per_function[function] = per_function.get(function, 0) + icount * ecount
+
+    total = sum(icount * ecount for _, icount, ecount in blocks) or 1
+    lines = [f'==== {title}: {assembly} ({len(blocks)} blocks reported) ====']
+    for pc, icount, ecount in blocks[:PROFILE_TOP]:
+        label, offset = lookup(symbols, label_addrs, pc)
+        function, _ = lookup(functions, function_addrs, pc)
+        weight = icount * ecount
+        where = label if offset == 0 else f'{label}+{offset:#x}'
+        lines.append(f'{pc:#010x} {where} ({function}) exec={ecount} insns={icount}'
+                     f' weight={weight} ({weight / total:.2%} of reported)')
+        # 伪指令展开、链接器松弛以及跨越标签的翻译块都会使 .s 中的行与实际执行的
+        # 指令对不上，因此标签只用于命名，指令一律从可执行文件反汇编
+        for insn in disassemble(executable, pc, icount):
+            lines.append(f'    | {insn}')
+    return lines, per_function
+
+
+def profile(
+    config: Config,
+    testcase: str,
+    workdir: str,
+    assembly: str,
+    gcc_assembly: str,
+    input: str
+) -> Optional[str]:
+    ours = hot_blocks(workdir, assembly, input)
+    theirs = hot_blocks(workdir, gcc_assembly, input)
+    if ours is None or theirs is None:
+        print(testcase, '\033[0;33mProfile failed\033[0m', flush=True)
+        return None
+    our_lines, our_functions = annotate('ours', assembly, *ours)
+    their_lines, their_functions = annotate(config.rival_compiler, gcc_assembly, *theirs)
+    report = os.path.join(config.tempdir, f'{testcase}.profile')
+    with open(report, 'w') as f:
+        f.write(f'# function weights are summed over the blocks reported by {qemu_plugin_path};\n'
+                f'# the stock libhotblocks.so only reports the 20 most executed blocks,\n'
+                f'# so this table is partial rather than a full function profile.\n')
+        f.write(f'{"function":<32}{"ours":>16}{config.rival_compiler:>16}\n')
+        for function in sorted(set(our_functions) | set(their_functions),
+                               key=lambda n: our_functions.get(n, 0), reverse=True):
+            f.write(f'{function:<32}{our_functions.get(function, 0):>16}'
+                    f'{their_functions.get(function, 0):>16}\n')
+        f.write('\n' + '\n'.join(our_lines) + '\n\n' + '\n'.join(their_lines) + '\n')
+    return report
+
+
 def test(config: Config, testcase: str, score_callback = None) -> str:
+    # 每次测试使用独立的目录，出结果后立即删除，使磁盘占用不随测例数增长
+    workdir = tempfile.mkdtemp(prefix=f'{testcase}-', dir=config.tempdir)
+    result = None
+    try:
+        result = judge(config, testcase, workdir, score_callback)
+    finally:
+        # 出现异常或被中断时 result 为 None，按未通过处理
+        if config.keep_all or (config.keep_failed and result != 'Passed'):
+            print(testcase, f'\033[0;34mArtifacts kept in {workdir}\033[0m', flush=True)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def create_run_dir(workdir: str) -> str:
+    os.makedirs(workdir, exist_ok=True)
+    prune_run_dirs(workdir)
+    # 每次运行使用独立的工作目录，多个分片可以在同一台机器上同时运行
+    rundir = tempfile.mkdtemp(prefix='run-', dir=workdir)
+    with open(os.path.join(rundir, 'owner'), 'w') as f:
+        f.write(f'{socket.gethostname()} {os.getpid()}')
+    return rundir
+
+
+def prune_run_dirs(workdir: str):
+    # 删除被 SIGKILL 等方式异常终止、来不及清理的运行目录。
+    # 正常结束时 owner 文件会被删除，因此特意保留的目录不会被删除
+    for rundir in glob(os.path.join(workdir, 'run-*')):
+        try:
+            host, pid = open(os.path.join(rundir, 'owner')).read().split()
+        except (OSError, ValueError):
+            continue
+        if host != socket.gethostname():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            shutil.rmtree(rundir, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def clean_run_dir(config: Config):
+    # 没有需要保留的内容时删除整个运行目录，否则提示手动清理
+    try:
+        os.remove(os.path.join(config.tempdir, 'owner'))
+    except OSError:
+        pass
+    if config.keep_all or config.keep_failed or config.profile:
+        try:
+            os.rmdir(config.tempdir)
+        except OSError:
+            print(f'\033[0;34m[info]\033[0m artifacts kept in {config.tempdir},'
+                  f' remove it manually when no longer needed', flush=True)
+    else:
+        shutil.rmtree(config.tempdir, ignore_errors=True)
+
+
+def judge(config: Config, testcase: str, workdir: str, score_callback = None) -> str:
     global rival_time
     global rival_time_lock
     source = os.path.join(config.testcases, f'{testcase}.sy')
     input = os.path.join(config.testcases, f'{testcase}.in')
     answer = os.path.join(config.testcases, f'{testcase}.out')
 
-    ident = '%04d' % random.randint(0, 9999)
-    assembly = os.path.join(config.tempdir, f'{testcase}-{ident}.s')
-    gcc_assembly = os.path.join(config.tempdir, f'{testcase}-gcc.s')
+    assembly = os.path.join(workdir, f'{testcase}.s')
+    gcc_assembly = os.path.join(workdir, f'{testcase}-gcc.s')
     # NOTE: 你可以在这里修改调用你的编译器的方式
     command = (f'ulimit -s unlimited && {config.compiler} -O{config.optimize_level} {source}'
                 f' -o {assembly}')
@@ -216,20 +525,20 @@ def test(config: Config, testcase: str, score_callback = None) -> str:
     except subprocess.TimeoutExpired:
         proc.kill()
         print(testcase, '\033[0;31mCompiler TLE\033[0m', flush=True)
-        return '\033[0;31mCompiler TLE\033[0m'
+        return 'Compiler TLE'
     if proc.returncode != 0:
         print(testcase, '\033[0;31mCompiler Error\033[0m', flush=True)
-        return '\033[0;31mCompiler Error\033[0m'
-    result = run(config.tempdir, assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
+        return 'Compiler Error'
+    result = run(workdir, assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
     if result == Result.LINKER_ERROR:
         print(testcase, '\033[0;31mLinker Error\033[0m', flush=True)
-        return '\033[0;31mLinker Error\033[0m'
+        return 'Linker Error'
     elif result == Result.WRONG_ANSWER:
         print(testcase, '\033[0;31mWrong Answer\033[0m', flush=True)
-        return '\033[0;31mWrong Answer\033[0m'
+        return 'Wrong Answer'
     elif result == Result.TIME_LIMIT_EXCEEDED:
         print(testcase, '\033[0;31mTime Limit Exceeded\033[0m', flush=True)
-        return '\033[0;31mTime Limit Exceeded\033[0m'
+        return 'Time Limit Exceeded'
     else:
         runtime = result
     # print(' ', end='')
@@ -248,13 +557,13 @@ def test(config: Config, testcase: str, score_callback = None) -> str:
             gcc_result = rival_time.get(name_body)
             rival_time_lock.release()
             if gcc_result is None:
-                gcc_result = run(config.tempdir, gcc_assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
+                gcc_result = run(workdir, gcc_assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
         else:
-            gcc_result = run(config.tempdir, gcc_assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
+            gcc_result = run(workdir, gcc_assembly, input, answer, TEST_ROUND, config.timing, config.on_riscv)
         
     if isinstance(gcc_result, Result):
         print(testcase, '\033[0;31mGCC Error\033[0m', flush=True)
-        return '\033[0;31mGCC Error\033[0m'
+        return 'GCC Error'
     else:
         if config.store_time:
             rival_time_lock.acquire()
@@ -266,16 +575,125 @@ def test(config: Config, testcase: str, score_callback = None) -> str:
         score = min(gcc_result / runtime * 100, 100)
         if score_callback is not None:
             score_callback(testcase, score)
+        if config.profile and runtime > gcc_result:
+            report = profile(config, testcase, workdir, assembly, gcc_assembly, input)
+            if report is not None:
+                print(testcase, f'\033[0;33mProfile: {report}\033[0m', flush=True)
     return 'Passed'
 
 
+def write_result(
+    config: Config,
+    testcases: list[str],
+    statuses: dict[str, str],
+    score_info: list,
+    durations: dict[str, float]
+):
+    scores = dict(score_info)
+    # --profile 额外运行的 qemu 会使耗时失真，不应作为下次分片的权重
+    results = {testcase: {"status": status,
+                          "score": scores.get(testcase),
+                          "duration": None if config.profile else durations.get(testcase)}
+               for testcase, status in sorted(statuses.items())}
+    with open(config.result, 'w') as f:
+        json.dump({"suite": get_suite(config.testcases),
+                   "testcases": get_all_testcases(config),
+                   "selected": testcases,
+                   "shard": list(config.shard) if config.shard is not None else [1, 1],
+                   "timing": config.timing,
+                   "results": results}, f, indent=2)
+
+
+def colored_status(status: str) -> str:
+    return f'\033[0;31m{status}\033[0m'
+
+
+def print_summary(failed: list[str], scores: list[float], timing: bool):
+    info = '\033[0;34m[info]\033[0m {}'
+    if not failed:
+        print(info.format('All Passed'), flush=True)
+
+        if timing:
+            mean_score = arithmetic_mean(scores)
+            print("final score:", mean_score, flush=True)
+    else:
+        for testcase in failed:
+            print(info.format(f'{testcase}'), flush=True)
+
+
+def merge(argv: list[str]) -> list[str]:
+    parser = ArgumentParser('simple-tester merge')
+    parser.add_argument('results', metavar='<result>', nargs='+',
+                        help='result files written by --result, one per shard')
+    parser.add_argument("--durations", metavar='<durations>', default=None,
+                        help='json file to update with the durations of the merged run')
+    args = parser.parse_args(argv)
+    results = {}
+    shards = set()
+    suite, testcases, timing = None, None, False
+    failed = []
+    selected = {}
+    for file in args.results:
+        with open(file, 'r') as f:
+            content = json.load(f)
+        if suite is None:
+            suite, testcases = content["suite"], content["testcases"]
+        elif suite != content["suite"] or testcases != content["testcases"]:
+            raise ValueError(f'{file} is a result of a different testcase suite than {args.results[0]}')
+        shards.add(tuple(content["shard"]))
+        timing |= content["timing"]
+        for testcase in content["selected"]:
+            if testcase in selected:
+                failed.append(f'`{testcase}` selected by both {selected[testcase]} and {file}')
+            else:
+                selected[testcase] = file
+            if testcase in content["results"]:
+                results.setdefault(testcase, content["results"][testcase])
+            else:
+                failed.append(f'`{testcase}` has no result in {file}')
+
+    for testcase in sorted(set(testcases) - set(selected)):
+        failed.append(f'`{testcase}` not selected by any shard')
+    for testcase in sorted(set(selected) - set(testcases)):
+        failed.append(f'`{testcase}` is not in the testcase suite')
+    failed += ['`' + testcase + "` " + colored_status(result["status"])
+               for testcase, result in sorted(results.items()) if result["status"] != 'Passed']
+    counts = {count for _, count in shards}
+    if len(counts) != 1:
+        failed.append(f'inconsistent shard counts: {sorted(counts)}')
+    else:
+        count = counts.pop()
+        for index in range(1, count + 1):
+            if (index, count) not in shards:
+                failed.append(f'missing shard {index}/{count}')
+    scores = [result["score"] for result in results.values() if result["score"] is not None]
+    print_summary(failed, scores, timing)
+
+    if args.durations is not None:
+        all_durations = {}
+        if os.path.exists(args.durations):
+            with open(args.durations, 'r') as f:
+                all_durations = json.load(f)
+        durations = all_durations.setdefault(suite, {})
+        durations.update({testcase: result["duration"] for testcase, result in results.items()
+                          if result["duration"] is not None})
+        with open(args.durations, 'w') as f:
+            json.dump(all_durations, f, indent=2)
+    return failed
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['merge']:
+        failed = merge(sys.argv[2:])
+        assert not failed, "Test Fail"
+        sys.exit(0)
+
     config = get_config(sys.argv[1:])
     testcases = get_testcases(config)
 
-    if os.path.exists(config.tempdir):
-        shutil.rmtree(config.tempdir)
-    os.mkdir(config.tempdir)
+    # CI 取消或超时通常发送 SIGTERM，转为 SystemExit 以便执行下面的清理
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    config = config._replace(tempdir=create_run_dir(config.tempdir))
 
     score_info = []
     scores_lock = Lock()
@@ -285,24 +703,40 @@ if __name__ == '__main__':
         scores_lock.release()
     score_callback = add_score if config.timing else None
 
+    statuses = {}
+    durations = {}
+    def timed_test(testcase):
+        start_time = time.time()
+        result = test(config, testcase, score_callback)
+        scores_lock.acquire()
+        statuses[testcase] = result
+        durations[testcase] = time.time() - start_time
+        scores_lock.release()
+        return testcase, result
+
     failed = []
-    if config.parallel:
-        futures = []
-        f = lambda t: (t, test(config, t, score_callback))
-        with ThreadPoolExecutor() as executor:
+    try:
+        if config.parallel:
+            futures = []
+            executor = ThreadPoolExecutor()
+            try:
+                for testcase in testcases:
+                    futures.append(executor.submit(timed_test, testcase))
+                for future in as_completed(futures):
+                    testcase, ok = future.result()
+                    if ok != 'Passed':
+                        failed.append('`' + testcase + "` " + colored_status(ok))
+            finally:
+                # 被中断时不再开始尚未运行的测例，只等待正在运行的测例清理完毕
+                executor.shutdown(cancel_futures=True)
+            failed.sort()
+        else:
             for testcase in testcases:
-                futures.append(executor.submit(f, testcase))
-            for future in as_completed(futures):
-                testcase, ok = future.result()
-                if ok != 'Passed':
-                    failed.append('`' + testcase + "` " + ok)
-        failed.sort()
-    else:
-        for testcase in testcases:
-            result = test(config, testcase, score_callback)
-            if result != 'Passed':
-                failed.append('`' + testcase + "` " + result)
-    info = '\033[0;34m[info]\033[0m {}'
+                _, result = timed_test(testcase)
+                if result != 'Passed':
+                    failed.append('`' + testcase + "` " + colored_status(result))
+    finally:
+        clean_run_dir(config)
     if config.store_time:
         with open(f'./rivals/{config.rival_compiler}/{config.rival_compiler}.json', 'r') as f:
             rival_times = json.load(f)
@@ -311,13 +745,7 @@ if __name__ == '__main__':
         with open(f'./rivals/{config.rival_compiler}/{config.rival_compiler}.json', 'w') as f:
             rival_times[config.testcases] = rival_time
             json.dump(rival_times, f)
-    if not failed:
-        print(info.format('All Passed'), flush=True)
-
-        if config.timing:
-            mean_score = arithmetic_mean([t[1] for t in score_info])
-            print("final score:", mean_score, flush=True)
-    else:
-        for testcase in failed:
-            print(info.format(f'{testcase}'), flush=True)
+    if config.result is not None:
+        write_result(config, testcases, statuses, score_info, durations)
+    print_summary(failed, [t[1] for t in score_info], config.timing)
     assert not failed, "Test Fail"